@@ -1,13 +1,17 @@
 import geopandas as gpd
 import numpy as np
 import os
-import swifter
 import pandas as pd
 import sys
 import shapely
 from pathlib import Path
-from shapely.geometry import MultiLineString, Polygon, MultiPolygon, LineString
-from shapely.validation import make_valid
+from pyproj import CRS
+from shapely.geometry import MultiLineString, Polygon, MultiPolygon, box
+try:
+    import dask_geopandas
+except ImportError:
+    # dask-geopandas is only needed to cut large inputs in parallel
+    dask_geopandas = None
 sys.path.insert(1, os.path.join(sys.path[0], ".."))
 
 '''
@@ -21,6 +25,42 @@ Inital flow:
 '''
 
 
+def CutPolygon(cutters: np.ndarray, in_geom: Polygon, in_boundary: MultiLineString) -> MultiPolygon:
+    '''Cuts the input polygon by the cutter lines that intersect it'''
+
+    # Create a union between the cut lines and the polygon boundary so the lines are noded where they cross
+    cut_single = shapely.union_all(np.append(cutters, in_boundary))
+    # Convert the noded lines back into polygons
+    polygons = shapely.get_parts(shapely.polygonize(shapely.get_parts(cut_single)))
+    # Closed cut lines can form polygons outside the input so keep only the pieces that fall within it (prepares the input if not already prepared)
+    shapely.prepare(in_geom)
+    polygons = polygons[shapely.contains(in_geom, shapely.point_on_surface(polygons))]
+    # Ensure result is a MultiPolygon and return it
+    return shapely.multipolygons(polygons)
+
+
+def _cut_partition(bp: gpd.GeoDataFrame, line_geoms: np.ndarray) -> gpd.GeoSeries:
+    '''Runs CutPolygon over every polygon in the input that intersects a line. Polygons with no intersects are returned unchanged'''
+    bp_geoms = np.asarray(bp.geometry.values)
+    cut_geom = bp_geoms.copy()
+
+    # Prepare the polygons once so the intersect query and the piece checks in CutPolygon share the prepared geometry
+    shapely.prepare(bp_geoms)
+
+    # Find every line each polygon intersects in one query and group the lines by polygon
+    bp_pos, line_pos = shapely.STRtree(line_geoms).query(bp_geoms, predicate='intersects')
+    order = np.argsort(bp_pos, kind='stable')
+    bp_pos = bp_pos[order]
+    line_pos = line_pos[order]
+    cut_pos, group_starts = np.unique(bp_pos, return_index=True)
+    line_groups = np.split(line_pos, group_starts[1:])
+
+    bp_boundaries = shapely.boundary(bp_geoms[cut_pos])
+    for pos, lines, boundary in zip(cut_pos, line_groups, bp_boundaries):
+        cut_geom[pos] = CutPolygon(line_geoms[lines], bp_geoms[pos], boundary)
+    return gpd.GeoSeries(cut_geom, index=bp.index, crs=bp.crs)
+
+
 class PC:
     
     '''
@@ -40,191 +80,96 @@ class PC:
     proj_crs: projected crs will be the crs of the output layers
 
     sliver_max_area: the maximum area of a split polygon that will be defined as a sliver and not included in the output  
+
+    dask_threshold: the number of polygons above which the cutting is run in parallel partitions using dask-geopandas (optional, without it all polygons are cut in a single partition)
     '''
 
-    def __init__(self, bld_poly: gpd.GeoDataFrame, cut_geom: gpd.GeoDataFrame, point_data=None, crs=4326, proj_crs=32614, sliver_max_area=20) -> None:
+    def __init__(self, bld_poly: gpd.GeoDataFrame, cut_geom: gpd.GeoDataFrame, point_data=None, crs=4326, proj_crs=32614, sliver_max_area=20, dask_threshold=50000) -> None:
         
-        def reproject(ingdf: gpd.GeoDataFrame, output_crs: int) -> gpd.GeoDataFrame:
-            ''' Takes a gdf and tests to see if it is in the projects crs if it is not the funtions will reproject '''
+        def reproject(ingdf: gpd.GeoDataFrame, output_crs: CRS) -> gpd.GeoDataFrame:
+            ''' Takes a gdf and tests to see if it is in the output crs if it is not the funtions will reproject '''
             if ingdf.crs == None:
-                ingdf.set_crs(epsg=output_crs, inplace=True)    
-            elif ingdf.crs != f'epsg:{output_crs}':
-                ingdf.to_crs(epsg=output_crs, inplace=True)
+                ingdf.set_crs(output_crs, inplace=True)    
+            elif not ingdf.crs.equals(output_crs):
+                ingdf.to_crs(output_crs, inplace=True)
             return ingdf
 
         
-        def ValidateGeometry(input_geometry: shapely.geometry) -> gpd.GeoSeries:
+        def ValidateGeometry(input_geometry: gpd.GeoSeries) -> gpd.GeoSeries:
             '''Checks if input geometry is valid and if invalid attempts to make it valid accepts Geodataframes and Geoseries'''
-            if type(input_geometry) == gpd.GeoSeries:
-                input_geometry = input_geometry.apply(lambda geom: make_valid(geom))
             if type(input_geometry) == gpd.GeoDataFrame:
-                input_geometry = input_geometry['geometry'].apply(lambda geom: make_valid(geom) if not geom.is_valid else geom)
-            return input_geometry
-
-
-        def ToSingleLines(geom: shapely.geometry) -> MultiLineString:
-            '''Converts polygons into single lines'''
-                
-            def MultiLineDevolver(m_line_string: MultiLineString) -> list:
-                '''Converts a multilinestring into a list of its component lines'''
-                m_line_string = [l for l in m_line_string.geoms]
-                m_line_string = [list(map(LineString, zip(l.coords[:-1], l.coords[1:]))) for l in m_line_string]
-                m_line_string = [ls for l in m_line_string for ls in l]
-                return m_line_string
-
-            # temp measure to remove GeometryCollections and None cases
-            if geom.geom_type not in ['MultiPolygon', 'Polygon', 'LineString', 'MultiLineString', 'Point', 'MultiPoint']:
-                # Temp block in place until a solution is found for GeometryCollections
-                print(geom)
-                sys.exit()
-                return None
-                
+                input_geometry = input_geometry.geometry
+            # make_valid returns valid geometry unchanged so there is no need to check is_valid first
+            return gpd.GeoSeries(shapely.make_valid(input_geometry.values), index=input_geometry.index, crs=input_geometry.crs)
 
-            if geom.geom_type in ['LineString', 'MultiLineString']:
-                # If linestring type then no need to worry about boundaries
-                if geom.geom_type == 'MultiLineString':
-                    # Extra step for multi line strings need to be devolved first
-                    geom = MultiLineDevolver(geom)
-                    return geom
-                
-                # LineStrings get converted into a list of lines in a single step
-                lines = list(map(LineString, zip(geom.coords[:-1], geom.coords[1:])))
-                return lines
-                
 
+        def ToSingleLines(geoms: np.ndarray) -> tuple:
+            '''Converts an array of polygons or multipolygons into single lines. Returns the lines and the position of the source polygon for each line'''
 
-            if geom.geom_type in ['Polygon', 'MultiPolygon']:
-
-                bounds = geom.boundary # returns the boundary as a linestring of many lines. Need to cut this into individual lines
-                
-                # multilinestrings need to be handled slightly differently
-                if bounds.geom_type == 'MultiLineString':
-                    # Extract each line from a multilinestring and return as a list of singe line linestrings
-                    # inefficient way to do this but need to extract each line from a multilinestring perhaps look at this again later 
-                    bounds = MultiLineDevolver(bounds)
-                    return bounds
-
-                # if its just a single line string then deconstruct to single geometries
-                try:
-                    line_bounds = list(map(LineString, zip(bounds.coords[:-1], bounds.coords[1:])))
-                    return line_bounds
-                
-                except NotImplementedError: # Not implimented error can't break down multipart geometry using this method
-                    print(bounds)
-                    sys.exit()
-
-
-        def SwapGeometry(ingdf: gpd.GeoDataFrame, orig_geom: str, swap_geom:str) -> gpd.GeoDataFrame:
-            '''Utility function swap from one geometry field to another and drop the original geometries and renames the new geometry column to 'geometry'
-            for the purposes of standardization'''
-            
-            # Swap in the new geometry
-            ingdf = ingdf.set_geometry(swap_geom)
-            # Delete the old geometry
-            ingdf.drop(columns=[orig_geom], inplace=True)
-            # Rename the geometry column to 'geometry'
-            ingdf.rename({swap_geom:'geometry'}, axis='columns', inplace=True)
-            # Ensure the column is set correctly by setting geometry again
-            ingdf = ingdf.set_geometry('geometry')
-            
-            return ingdf
+            # Split multipolygons into their parts then take the rings straight from the parts so that no line is created between two rings
+            parts, part_parents = shapely.get_parts(geoms, return_index=True)
+            rings, ring_parts = shapely.get_rings(parts, return_index=True)
+            ring_parents = part_parents[ring_parts]
+            coords, coord_rings = shapely.get_coordinates(rings, return_index=True)
+            # Only consecutive coordinates from the same ring make up a line
+            same_ring = coord_rings[:-1] == coord_rings[1:]
+            lines = shapely.linestrings(np.stack([coords[:-1][same_ring], coords[1:][same_ring]], axis=1))
+            return lines, ring_parents[coord_rings[:-1][same_ring]]
 
 
         def check_geom(input_gdf: gpd.GeoDataFrame, geometry_column= 'geometry') -> gpd.GeoDataFrame:
             '''Checks to see if the input  geometry is a line. If polygon converts to lines. If points or other returns a geometry error'''                         
 
             #input_gdf.reset_index(inplace=True)
-            if input_gdf.geometry[0].geom_type in ['LineString', 'MultiLineString']:
+            if input_gdf.geometry.iloc[0].geom_type in ['LineString', 'MultiLineString']:
                 # If the geometry is already in line type
                 return input_gdf
             
             # If inputs are polygons then convert them to lines
-            if input_gdf.geometry[0].geom_type in ['Polygon', 'MultiPolygon']:
+            if input_gdf.geometry.iloc[0].geom_type in ['Polygon', 'MultiPolygon']:
                 
-                # explode to remove multipolygons
-                input_gdf = input_gdf.explode(index_parts=False)
-                # convert linestrings into single linestrings 
-                input_gdf['single_lines'] = input_gdf['geometry'].swifter.apply(lambda p: ToSingleLines(p))
-                # explode list output of prior function
-                output_gdf = input_gdf.explode('single_lines')
-                # switch geometry to the new geom and drop old geom
-                output_gdf = SwapGeometry(output_gdf, 'geometry', 'single_lines')
+                # convert the polygon boundaries into single linestrings 
+                single_lines, parents = ToSingleLines(input_gdf.geometry.values)
+                # repeat the attributes of each polygon for every line created from it
+                output_gdf = gpd.GeoDataFrame(input_gdf.drop(columns=['geometry']).iloc[parents], geometry=single_lines, crs=input_gdf.crs)
 
                 return output_gdf
 
             # If the geometry is a point or mutipoint raise an error
-            if input_gdf.geometry[0].geom_type in ['Point', 'MultiPoint']:
+            if input_gdf.geometry.iloc[0].geom_type in ['Point', 'MultiPoint']:
                 raise IOError('Shape is not a Polygon or Line')
 
 
-        def FindIntersects(input_geom: gpd.GeoDataFrame, search_geometry: gpd.GeoDataFrame, input_link_field: str, search_link_field: str) -> gpd.GeoDataFrame:
-            '''finds all intersections between the input geometry and the search geometry'''
-
-            joined_geom = gpd.sjoin(input_geom, search_geometry[[search_link_field, 'geometry']], op='intersects')
-            input_geom['line_ints'] = input_geom[input_link_field].swifter.apply(lambda x: tuple(joined_geom[joined_geom[input_link_field] == x][search_link_field].tolist()))
-            return input_geom
-
+        # Output crs all layers are projected into
+        self._target = CRS.from_epsg(proj_crs)
 
-        def CutPolygon(intersect_indexes: tuple, in_geom: Polygon, line_geom:gpd.GeoDataFrame, cut_field:str) -> MultiPolygon:
-            '''Cuts the input polygon by the lines linked to it during the FindIntersects Step Run the FindIntersects step before calling this function'''
-           
-            # Select only key vars and set the cut indexes
-            line_geom = line_geom[[cut_field, 'geometry']]
-            cut_indexes = intersect_indexes
-
-            # Polygons with no intersects don't need to be split
-            if len(cut_indexes) == 0:
-                return in_geom
-            
-            # Polygons with intersects need to be split
-            if len(cut_indexes) >= 1:
-                # retrieve the records related to the cut indexes
-                cutters = line_geom[line_geom[cut_field].isin(cut_indexes)]
-                
-                # convert to a single LineString or MultiLineString
-                cut_single = [shapely.ops.linemerge(cutters.geometry.values.tolist())]
-                
-                # Convert the polygon into its boundary and append it to the cut lines list
-                cut_single.append(in_geom.boundary)
-                # Create a union between all the lines
-                cut_single = shapely.ops.unary_union(cut_single)
-                # merge all the lines into a single LineString or MultiLineString
-                cut_single = shapely.ops.linemerge(cut_single)
-                # Convert the linemerge result back into a polygon
-                polygons = shapely.ops.polygonize(cut_single)
-                # Ensure result is a MultiPolygon and return it
-                return MultiPolygon(polygons)
-
- 
         # Load in the inputs to geodataframes
         self.bp = bld_poly
         cut_geom = cut_geom
         # Ensure projection consistency
-        self.bp.to_crs(crs=crs, inplace=True)
-        cut_geom.to_crs(crs=crs, inplace=True)
+        crs = CRS.from_epsg(crs)
+        self.bp = reproject(self.bp, crs)
+        cut_geom = reproject(cut_geom, crs)
 
 
         # Ensure all valid geometry
         self.bp['geometry'] = ValidateGeometry(self.bp)
         cut_geom['geometry'] = ValidateGeometry(cut_geom)
         
-        # Calc unique values for data to link between datasets
-        self.bp['bp_index'] = range(1, len(self.bp.index) + 1)
-        cut_geom['cut_index'] = range(1, len(cut_geom.index) + 1)
+        # Prepare the buildings once so the intersect checks below, which query with the buildings, reuse the prepared geometry
+        shapely.prepare(self.bp.geometry.values)
 
         # Drop Non-Essential Cut Geometry
-        cut_joined = gpd.sjoin(cut_geom, self.bp[['bp_index', 'geometry']])
-        cut_joined = list(set(cut_joined[~cut_joined['bp_index'].isna()]['cut_index'].tolist()))
-        cut_geom = cut_geom[cut_geom['cut_index'].isin(cut_joined)]
+        _, cut_joined = shapely.STRtree(cut_geom.geometry.values).query(self.bp.geometry.values, predicate='intersects')
+        cut_geom = cut_geom.iloc[np.unique(cut_joined)]
         
         # if points are available filter out polygons that do not intersect with a point
         if type(point_data) == gpd.GeoDataFrame:
 
-            point_data.to_crs(crs=crs, inplace=True)
-            point_data['ap_index'] = range(1, len(point_data.index) + 1)
-            cut_joined_ap = gpd.sjoin(cut_geom, point_data[['ap_index', 'geometry']])
-            cut_joined_ap = list(set(cut_joined_ap[~cut_joined_ap['ap_index'].isna()]['cut_index'].tolist()))
-            cut_geom = cut_geom[cut_geom['cut_index'].isin(cut_joined_ap)]
+            point_data = reproject(point_data, crs)
+            ap_tree = shapely.STRtree(point_data.geometry.values)
+            cut_joined_ap, _ = ap_tree.query(cut_geom.geometry.values, predicate='intersects')
+            cut_geom = cut_geom.iloc[np.unique(cut_joined_ap)]
 
         # convert the cut geometry to lines if necessary
         print('Converting line geometry')
@@ -235,90 +180,115 @@ class PC:
         
         # ensure crs is consistent after the geometry change
         self.line_geom.set_crs(crs=crs, inplace=True)
-        # Create a new index for the lines
-        self.line_geom['line_index'] = range(1, len(self.line_geom.index) + 1)
         
         # Commented out as this leads to complex multiline situations. Keeping these lines in prevents that problem
         #Drop lines that do not intersect a building
-        lines_joined = gpd.sjoin(self.line_geom, self.bp[['bp_index', 'geometry']])
-        self.line_geom = self.line_geom[self.line_geom['line_index'].isin(list(set(lines_joined[~lines_joined['bp_index'].isna()]['line_index'].tolist())))]
+        _, lines_joined = shapely.STRtree(self.line_geom.geometry.values).query(self.bp.geometry.values, predicate='intersects')
+        self.line_geom = self.line_geom.iloc[np.unique(lines_joined)]
         
-        # Project data for overlap checks
-        self.line_geom = reproject(self.line_geom, proj_crs)
-        self.bp = reproject(self.bp, proj_crs)
+        # Project data for overlap checks and all following steps
+        self.line_geom = reproject(self.line_geom, self._target)
+        self.bp = reproject(self.bp, self._target)
 
         # Delete lines that overlap
         self.line_geom.reset_index(drop=True, inplace=True)
 
-        # Calc centroid for duplicate removal (lines don't work for this method)
-        self.line_geom['centroid'] = self.line_geom.geometry.centroid
-        # convert to wkb because drop duplicates doesn't work on shapely
-        self.line_geom['centroid'] = self.line_geom['centroid'].apply(lambda geom: geom.wkb)
-
-        self.line_geom = self.line_geom.drop_duplicates(['centroid']) # Drop the duplicate records
-
-        # convert back to shapely geometry (only necessary when using that geometry)
-        #self.line_geom['centroid'] = self.line_geom['centroid'].apply(lambda geom: shapely.wkb.loads(geom))
+        # Snap each line to a 1e-6 grid to round off reprojection noise then normalize it so that a line and its reverse
+        # have the same well known binary and can be compared as duplicates
+        line_keys = shapely.to_wkb(shapely.normalize(shapely.set_precision(self.line_geom.geometry.values, 1e-6, mode='pointwise')))
 
-        # Drop non essential centroid field
-        self.line_geom.drop(columns=['centroid'], inplace=True)
+        # Drop the duplicate records keeping the first occurrence of each line
+        _, first_lines = np.unique(line_keys, return_index=True)
+        self.line_geom = self.line_geom.iloc[np.sort(first_lines)]
         
-        # Check for and exclude non line geometries
-
-        self.line_geom['geom_type'] = self.line_geom.geometry.geom_type
-        self.line_geom = self.line_geom[self.line_geom['geom_type'].isin(['LineString', 'MultiLineString'])]
-        self.line_geom.drop(columns=['geom_type'], inplace=True)
+        # Check for and exclude non line geometries (type id 1 is LineString and 5 is MultiLineString)
+        line_types = shapely.get_type_id(self.line_geom.geometry.values)
+        self.line_geom = self.line_geom[np.isin(line_types, [1, 5])]
 
         # Remove multilinestrings by merging lines if possible
-        self.line_geom['singled_geom'] = self.line_geom['geometry'].apply(lambda x: shapely.ops.linemerge(x) if x.geom_type == 'MultiLineString' else x)
-             
-        self.line_geom = SwapGeometry(self.line_geom, 'geometry', 'singled_geom')
-        
-        # if any multilinestrings remain explode them as split cannot take multi geometry
-        multis = self.line_geom[self.line_geom.geometry.geom_type == 'MultiLineString']
+        line_geoms = np.asarray(self.line_geom.geometry.values)
+        singled_geom = np.where(shapely.get_type_id(line_geoms) == 5, shapely.line_merge(line_geoms), line_geoms)
+        self.line_geom = self.line_geom.assign(geometry=gpd.GeoSeries(singled_geom, index=self.line_geom.index, crs=self.line_geom.crs))
         
-        # if there are still multipolygons then use the following to remove them
-        if len(multis) > 0:
-            self.line_geom = self.line_geom[self.line_geom.geometry.geom_type != 'MultiLineString']
-            # explode and add the now single linestrings back into the data
-            multis = multis.explode(index_parts=False)
-            self.line_geom = self.line_geom.append(multis)
+        # if any multilinestrings remain explode them as split cannot take multi geometry (single linestrings are unaffected)
+        self.line_geom = self.line_geom.explode(index_parts=False, ignore_index=True)
         
-        self.line_geom['seg_index'] = range(1, len(self.line_geom.index) + 1)
-        
-        print('Finding intersects') 
-        self.line_geom = reproject(self.line_geom, proj_crs)
-        self.bp = reproject(self.bp, proj_crs)
-
-        self.bp = FindIntersects(self.bp, self.line_geom, 'bp_index', 'seg_index')
-
         print('Cutting by intersects')
         
         # Cut the polygons
-        cut_geom = self.bp[['line_ints', 'geometry']].swifter.apply(lambda x: CutPolygon(x.line_ints, x.geometry, self.line_geom[['seg_index', 'geometry']], 'seg_index'), axis=1)
-
-        self.bp['geometry'] = cut_geom
+        line_geoms = np.asarray(self.line_geom.geometry.values)
+
+        if len(self.bp.index) > dask_threshold and dask_geopandas != None:
+            # Large inputs are split into partitions that are cut in parallel
+            bp_partitions = dask_geopandas.from_geopandas(self.bp[['geometry']], npartitions=os.cpu_count() or 1, sort=False)
+            cut_geom = bp_partitions.map_partitions(_cut_partition, line_geoms, meta=gpd.GeoSeries([], crs=self.bp.crs)).compute()
+        else:
+            if len(self.bp.index) > dask_threshold:
+                print('dask-geopandas is not installed, cutting all polygons in a single partition')
+            cut_geom = _cut_partition(self.bp, line_geoms)
+
+        self.bp['geometry'] = gpd.GeoSeries(cut_geom.values, index=self.bp.index, crs=self.bp.crs)
         self.bp = self.bp.explode(index_parts=True)
-        self.bp.drop(columns=['line_ints'], inplace=True)
         
-        # Final split buildings crs check
-        self.line_geom = reproject(self.line_geom, proj_crs)
-        self.bp = reproject(self.bp, proj_crs)
-
         # Clean up results and remove slivers polygons with an area less than the max sliver area
-        self.bp['split_area'] = round(self.bp.geometry.area, 2)
+        split_areas = shapely.area(self.bp.geometry.values)
 
-        self.slivers = self.bp[self.bp.split_area <= sliver_max_area] # retain slivers for analysis purposes if needed
-        self.bp = self.bp[self.bp.split_area >= sliver_max_area]
-
-        # Drop temp fields
-        self.bp.drop(columns=['split_area', 'bp_index'], inplace=True)
-        self.line_geom.drop(columns=['cut_index', 'line_index', 'seg_index'], inplace=True)
+        self.slivers = self.bp[split_areas <= sliver_max_area] # retain slivers for analysis purposes if needed
+        self.bp = self.bp[split_areas >= sliver_max_area]
           
         
     def __call__(self, *args, **kwds):
         pass
 
+def cut_by_tiles(aoi_mask: gpd.GeoDataFrame, bld_path: Path, bld_lyr_nme: str, parcel_path: Path, addresses: gpd.GeoDataFrame, tiles_per_side: int=1) -> tuple:
+    '''Cuts the buildings touching the aoi tile by tile. Returns the cut buildings and the cut lines or None for both if no buildings were found'''
+    # Split the aoi into a grid of tiles so only one tile of buildings and parcels is held in memory at a time
+    minx, miny, maxx, maxy = aoi_mask.total_bounds
+    tile_w = (maxx - minx) / tiles_per_side
+    tile_h = (maxy - miny) / tiles_per_side
+
+    # Buildings only need to touch the aoi to be cut, prepare it once as every tile tests against it
+    aoi_geom = aoi_mask.union_all()
+    shapely.prepare(aoi_geom)
+
+    split_bp = []
+    split_lines = []
+    for col in range(tiles_per_side):
+        for row in range(tiles_per_side):
+            # Read by the whole tile so that buildings owned by this tile are read even when the aoi does not reach into the tile
+            tile_box = gpd.GeoSeries([box(minx + col * tile_w, miny + row * tile_h, minx + (col + 1) * tile_w, miny + (row + 1) * tile_h)], crs=aoi_mask.crs)
+            bld_gdf = gpd.read_file(bld_path, layer=bld_lyr_nme, bbox=tile_box, engine='pyogrio')
+            bld_gdf = bld_gdf[bld_gdf.geometry != None]
+            bld_aoi_geom = bld_gdf.geometry.to_crs(aoi_mask.crs)
+            in_aoi = shapely.intersects(aoi_geom, bld_aoi_geom.values)
+            bld_gdf = bld_gdf[in_aoi]
+            bld_aoi_geom = bld_aoi_geom[in_aoi]
+
+            # Buildings crossing a tile edge are read by both tiles so keep them only in the tile holding their representative point
+            rep_pts = bld_aoi_geom.representative_point()
+            rep_col = np.clip(((rep_pts.x - minx) // tile_w).astype(int), 0, tiles_per_side - 1)
+            rep_row = np.clip(((rep_pts.y - miny) // tile_h).astype(int), 0, tiles_per_side - 1)
+            bld_gdf = bld_gdf[(rep_col == col) & (rep_row == row)]
+            if len(bld_gdf) == 0:
+                continue
+
+            # Only the parcels around the buildings in this tile are needed to cut them
+            cut_gdf = gpd.read_file(parcel_path, bbox=gpd.GeoSeries([box(*bld_gdf.total_bounds)], crs=bld_gdf.crs), engine='pyogrio')
+            cut_gdf = cut_gdf[cut_gdf.geometry != None]
+
+            # Only the addresses around those parcels are needed to filter them
+            ap_minx, ap_miny, ap_maxx, ap_maxy = gpd.GeoSeries([box(*cut_gdf.total_bounds)], crs=cut_gdf.crs).to_crs(addresses.crs).total_bounds
+            tile_addresses = addresses.cx[ap_minx:ap_maxx, ap_miny:ap_maxy].copy()
+
+            clipped_polys = PC(bld_poly=bld_gdf, cut_geom=cut_gdf, point_data=tile_addresses)
+            split_bp.append(clipped_polys.bp)
+            split_lines.append(clipped_polys.line_geom)
+
+    if len(split_bp) == 0:
+        return None, None
+    return pd.concat(split_bp), pd.concat(split_lines)
+
+
 def main():
     # setup for testing purposes
     from dotenv import load_dotenv
@@ -338,21 +308,20 @@ def main():
     out_pcl_lyr_nme = os.getenv('PCL_LYR_NME')
 
     # Load in the data
-    aoi_mask = gpd.read_file(aoi_path, layer=aoi_lyr_nme)
-
-    bld_gdf = gpd.read_file(bld_path, layer=bld_lyr_nme, mask=aoi_mask)
-    bld_gdf = bld_gdf[bld_gdf.geometry != None]
-    
-    cut_gdf = gpd.read_file(parcel_path, mask=aoi_mask)
-    cut_gdf = cut_gdf[cut_gdf.geometry != None]
+    aoi_mask = gpd.read_file(aoi_path, layer=aoi_lyr_nme, engine='pyogrio')
+    addresses = gpd.read_file(ap_data, engine='pyogrio')
 
-    addresses = gpd.read_file(ap_data)
+    tiles_per_side = int(os.getenv('TILES_PER_SIDE', 1))
+    cut_bp, cut_lines = cut_by_tiles(aoi_mask, bld_path, bld_lyr_nme, parcel_path, addresses, tiles_per_side)
 
-    print('cutting buildings')
-    clipped_polys = PolygonCutter(bld_poly=bld_gdf, cut_geom=cut_gdf, point_data=addresses)
-    clipped_polys.bp.to_file(out_gpkg, layer=out_bld_lyr_nme)
-    clipped_polys.line_geom.to_file(out_gpkg, layer=out_pcl_lyr_nme)
+    if cut_bp is None:
+        print('No buildings found in the aoi')
+        return
 
+    cut_bp.to_file(out_gpkg, layer=out_bld_lyr_nme, driver='GPKG', engine='pyogrio')
+    # The cut lines are only needed to inspect the cuts so only write them out when debugging
+    if os.getenv('DEBUG_EXPORT'):
+        cut_lines.to_file(out_gpkg, layer=out_pcl_lyr_nme, driver='GPKG', engine='pyogrio')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,59 @@
+# coding=utf-8
+"""Polygon cutter tiling test."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+import shapely
+from shapely.geometry import Point, box
+
+from pc_class import cut_by_tiles
+
+
+class CutByTilesTest(unittest.TestCase):
+    """Test that cutting tile by tile gives the same output as one tile."""
+
+    def setUp(self):
+        """Runs before each test."""
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bld_path = os.path.join(self.tmp_dir, 'buildings.gpkg')
+        self.parcel_path = os.path.join(self.tmp_dir, 'parcels.gpkg')
+
+        # 8x8 grid of 100m parcels with a building straddling the east edge of every other parcel. The tiles read parcels
+        # by the bounds of their buildings so they also read parcels that touch no building
+        cells = range(8)
+        parcels = [box(x * 100, y * 100, (x + 1) * 100, (y + 1) * 100) for x in cells for y in cells]
+        buildings = [box(x * 100 + 80, y * 100 + 40, x * 100 + 120, y * 100 + 60) for x in cells for y in cells if (x + y) % 2 == 1]
+        addresses = [Point(x * 100 + 50, y * 100 + 50) for x in cells for y in cells]
+
+        gpd.GeoDataFrame({'p_id': range(len(parcels))}, geometry=parcels, crs=32614).to_file(self.parcel_path, driver='GPKG', engine='pyogrio')
+        gpd.GeoDataFrame({'b_id': range(len(buildings))}, geometry=buildings, crs=32614).to_file(self.bld_path, layer='buildings', driver='GPKG', engine='pyogrio')
+        self.addresses = gpd.GeoDataFrame({'a_id': range(len(addresses))}, geometry=addresses, crs=32614)
+        self.aoi = gpd.GeoDataFrame(geometry=[box(0, 0, 800, 800)], crs=32614)
+
+    def tearDown(self):
+        """Runs after each test."""
+        shutil.rmtree(self.tmp_dir)
+
+    def cut_pieces(self, tiles_per_side):
+        """Returns the cut building pieces as sorted normalized wkt."""
+        cut_bp, _ = cut_by_tiles(self.aoi, self.bld_path, 'buildings', self.parcel_path, self.addresses.copy(), tiles_per_side)
+        pieces = shapely.normalize(shapely.set_precision(cut_bp.geometry.values, 1e-3))
+        return sorted(zip(cut_bp['b_id'], shapely.to_wkt(pieces)))
+
+    def test_tiles_match_single_tile(self):
+        """Test that cutting with more than one tile gives the same pieces as one tile."""
+        single_tile = self.cut_pieces(1)
+        self.assertEqual(len(single_tile), 64)
+        for tiles_per_side in [2, 3, 5]:
+            self.assertEqual(self.cut_pieces(tiles_per_side), single_tile)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(CutByTilesTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
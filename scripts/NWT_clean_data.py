@@ -1,5 +1,4 @@
 from dataclasses import field
-import swifter
 import datetime
 import sys
 import shapely
@@ -7,7 +6,6 @@ import os
 import re
 import string
 from pathlib import Path
-import fiona
 import geopandas as gpd
 import numpy as np
 import pandas as pd
@@ -33,29 +31,13 @@ def getXY(pt):
     return (pt.x, pt.y)
 
 
-def records(filename, usecols, **kwargs):
-    ''' Allows for importation of file with only the desired fields must use from_features for importing output into geodataframe'''
-    with fiona.open(filename, **kwargs) as source:
-        for feature in source:
-            f = {k: feature[k] for k in ['id', 'geometry']}
-            f['properties'] = {k: feature['properties'][k] for k in usecols}
-            yield f
-
-
 def return_smallest_match(ap_matches, parcel_df, unique_id, area_field_name='AREA'):
     '''Takes plural matches of buildings or address points and compares them against the size of the matched parcel. Returns only the smallest parcel that was matched'''
-    ap_matches['ap_match_id'] = range(1, len(ap_matches.index)+1)
-    o_ids = []
-    for rid in list(set(ap_matches[unique_id].tolist())):
-        rid_matches = ap_matches[ap_matches[unique_id] == rid]
-        rid_ids = list(set(rid_matches['link_field'].tolist()))
-        match_parcels = parcel_df[parcel_df['link_field'].isin(rid_ids)]
-        match_parcels.sort_values(by=[area_field_name], inplace=True, ascending=True)
-        min_parcel_link = match_parcels['link_field'].tolist()[0]
-        o_ids.append(rid_matches[rid_matches['link_field'] == min_parcel_link].ap_match_id.tolist()[0])
-    ap_matches = ap_matches[ap_matches['ap_match_id'].isin(o_ids)]
-    ap_matches.drop(columns=['ap_match_id'], inplace=True)
-    return ap_matches
+    # Attach the area of the matched parcel to each match and keep the first match on the smallest parcel per unique id
+    match_areas = ap_matches['link_field'].map(parcel_df.set_index('link_field')[area_field_name])
+    smallest = ap_matches[[unique_id]].assign(match_area=match_areas.values, match_pos=np.arange(len(ap_matches.index)))
+    smallest = smallest.sort_values(by=[unique_id, 'match_area'], ascending=True).drop_duplicates(subset=[unique_id], keep='first')
+    return ap_matches.iloc[np.sort(smallest['match_pos'].values)]
     
 
 def shed_flagging(footprint_gdf, address_gdf, linking_gdf):
@@ -112,8 +94,8 @@ def shed_flagging(footprint_gdf, address_gdf, linking_gdf):
     bf_parcel_linkages = footprint_gdf.groupby('link_field', dropna=True)['link_field'].count()
 
     # Return only cases where the bf count is higher than the adp count
-    adp_parcel_l_bf = adp_parcel_linkages[adp_parcel_linkages.index.isin(bf_parcel_linkages.index.tolist())]
-    bf_parcel_l_ap = bf_parcel_linkages[bf_parcel_linkages.index.isin(adp_parcel_linkages.index.tolist())]
+    adp_parcel_l_bf = adp_parcel_linkages[adp_parcel_linkages.index.isin(bf_parcel_linkages.index)]
+    bf_parcel_l_ap = bf_parcel_linkages[bf_parcel_linkages.index.isin(adp_parcel_linkages.index)]
 
     bf_parcel_l_ap = pd.DataFrame(bf_parcel_l_ap)
     bf_parcel_l_ap.rename(columns={ bf_parcel_l_ap.columns[0]: "bf_count"}, inplace=True)
@@ -121,17 +103,18 @@ def shed_flagging(footprint_gdf, address_gdf, linking_gdf):
     adp_parcel_l_bf = pd.DataFrame(adp_parcel_l_bf)
     adp_parcel_l_bf.rename(columns={adp_parcel_l_bf.columns[0]: "ap_count"}, inplace=True)
 
-    linking_gdf = linking_gdf.loc[linking_gdf['link_field'].isin(bf_parcel_l_ap.index.tolist())]
+    linking_gdf = linking_gdf.loc[linking_gdf['link_field'].isin(bf_parcel_l_ap.index)]
     linking_gdf['shed_list'] = linking_gdf['link_field'].apply(lambda x: find_sheds(footprint_gdf[footprint_gdf['link_field'] == x], adp_parcel_l_bf[adp_parcel_l_bf.index == x].ap_count.tolist()[0]))
     shed_indexes = [ i for l in linking_gdf['shed_list'].tolist() for i in l ] # item for sublist in t for item in sublist: t being the shed_list list
 
-    shed_gdf = footprint_gdf[footprint_gdf['bf_index'].isin(shed_indexes)]
-    footprint_gdf = footprint_gdf.loc[~footprint_gdf['bf_index'].isin(shed_indexes)]
+    is_shed = footprint_gdf['bf_index'].isin(shed_indexes)
+    shed_gdf = footprint_gdf[is_shed]
+    footprint_gdf = footprint_gdf.loc[~is_shed]
 
     shed_gdf['shed_flag'] = True
     round_sheds['shed_flag'] = True
     footprint_gdf['shed_flag'] = False
-    footprint_gdf = footprint_gdf.append([shed_gdf, round_sheds])
+    footprint_gdf = pd.concat([footprint_gdf, shed_gdf, round_sheds])
     return footprint_gdf
 
 
@@ -168,10 +151,10 @@ rd_crs = os.getenv('RD_CRS')
 # Logic
 
 if aoi_mask != None:
-    aoi_gdf = gpd.read_file(aoi_mask)
+    aoi_gdf = gpd.read_file(aoi_mask, engine='pyogrio')
 
 print('Loading in linking data')
-linking_data = gpd.read_file(linking_data_path, layer=linking_lyr_nme, linking_ignore_columns=linking_ignore_columns, mask=aoi_gdf)
+linking_data = gpd.read_file(linking_data_path, layer=linking_lyr_nme, linking_ignore_columns=linking_ignore_columns, mask=aoi_gdf, engine='pyogrio')
 linking_data = reproject(linking_data, proj_crs)
 linking_cols_drop = linking_data.columns.tolist()
 linking_data['link_field'] = range(1, len(linking_data.index)+1)
@@ -183,10 +166,10 @@ for col in ['geometry', 'filenumber', 'AREA']:
         linking_cols_drop.remove(col)
 
 linking_data.drop(columns=linking_cols_drop, inplace=True)
-linking_data.to_file(project_gpkg, layer='parcels_cleaned', driver='GPKG')
+linking_data.to_file(project_gpkg, layer='parcels_cleaned', driver='GPKG', engine='pyogrio')
 
 print('Loading in address data')
-addresses = gpd.read_file(ap_path, layer=ap_lyr_nme, mask=aoi_gdf)
+addresses = gpd.read_file(ap_path, layer=ap_lyr_nme, mask=aoi_gdf, engine='pyogrio')
 
 print('Cleaning and prepping address points')
 
@@ -194,19 +177,18 @@ addresses = reproject(addresses, proj_crs)
 addresses['a_id'] = range(1, len(addresses.index)+1)
 addresses = gpd.sjoin(addresses, linking_data[['link_field', 'geometry']], op='within', how='left')
 
-grouped = addresses.groupby('a_id', dropna=True)['a_id'].count()
-grouped = grouped[grouped > 1].index.tolist()
-addresses_plural_sj = addresses[addresses['a_id'].isin(grouped)]
-addresses_singular = addresses[~addresses['a_id'].isin(grouped)]
+grouped = addresses['a_id'].duplicated(keep=False) & addresses['a_id'].notna()
+addresses_plural_sj = addresses[grouped]
+addresses_singular = addresses[~grouped]
 addresses_plural_sj = return_smallest_match(addresses_plural_sj, linking_data, 'a_id')
-addresses = addresses_singular.append(addresses_plural_sj)
+addresses = pd.concat([addresses_singular, addresses_plural_sj])
 addresses.drop(columns=['index_right'], inplace=True)
 
 print('Exporting cleaned address dataset')
-addresses.to_file(project_gpkg, layer='addresses_cleaned', driver='GPKG')
+addresses.to_file(project_gpkg, layer='addresses_cleaned', driver='GPKG', engine='pyogrio')
 
 print('Loading in footprint data')
-footprint = gpd.read_file(footprint_lyr, layer=footprint_lyr_name ,mask=aoi_gdf)
+footprint = gpd.read_file(footprint_lyr, layer=footprint_lyr_name ,mask=aoi_gdf, engine='pyogrio')
 
 footprint = reproject(footprint, proj_crs)
 
@@ -220,28 +202,29 @@ footprint.rename(columns={'index':'bf_index'}, inplace=True)
 footprint.set_index(footprint['bf_index'])
 footprint = reproject(footprint, proj_crs)
 
-footprint['centroid_geo'] = footprint['geometry'].swifter.apply(lambda pt: pt.centroid)
-footprint = footprint.set_geometry('centroid_geo')
-footprint = gpd.sjoin(footprint, linking_data[['link_field', 'geometry']], how='left', op='within')
-
-grouped_bf = footprint.groupby('bf_index', dropna=True)['bf_index'].count()
-grouped_bf = grouped_bf[grouped_bf > 1].index.tolist()
-footprint_plural_sj = footprint[footprint['bf_index'].isin(grouped_bf)]
-footprint_singular = footprint[~footprint['bf_index'].isin(grouped_bf)]
+# Link each footprint to the parcels its centroid falls within
+bf_pos, link_pos = shapely.STRtree(linking_data.geometry.values).query(shapely.centroid(footprint.geometry.values), predicate='within')
+# Footprints without a parcel are kept with an empty link as in a left join
+no_link = np.setdiff1d(np.arange(len(footprint.index)), bf_pos)
+bf_pos = np.concatenate([bf_pos, no_link])
+link_order = np.argsort(bf_pos, kind='stable')
+footprint = footprint.iloc[bf_pos[link_order]]
+footprint['link_field'] = np.concatenate([linking_data['link_field'].values[link_pos], np.full(len(no_link), np.nan)])[link_order]
+
+grouped_bf = footprint['bf_index'].duplicated(keep=False) & footprint['bf_index'].notna()
+footprint_plural_sj = footprint[grouped_bf]
+footprint_singular = footprint[~grouped_bf]
 footprint_plural_sj = return_smallest_match(footprint_plural_sj, linking_data, 'bf_index')
-footprint = footprint_singular.append(footprint_plural_sj)
+footprint = pd.concat([footprint_singular, footprint_plural_sj])
 
 footprint = shed_flagging(footprint, addresses, linking_data)
 
-footprint = footprint.set_geometry('geometry')
-footprint.drop(columns=['centroid_geo'], inplace=True)
-
 for f in ['index_right', 'index_left', 'OBJECTID', 'fid']:
     if f in footprint.columns.tolist():
         footprint.drop(columns=f, inplace=True)
 
 print('Exporting cleaned dataset')
-footprint.to_file(project_gpkg, layer='footprints_cleaned', driver='GPKG')
+footprint.to_file(project_gpkg, layer='footprints_cleaned', driver='GPKG', engine='pyogrio')
 
 end_time = datetime.datetime.now()
 print(f'Start Time: {start_time}')
@@ -7,7 +7,6 @@ from pathlib import Path
 from math import isnan
 import shapely.speedups
 import datetime
-import swifter
 shapely.speedups.enable()
 
 '''
@@ -123,7 +122,7 @@ def main():
     print('Grouping BFs')
     grouped_bf = footprints[footprints['shed_flag'] == False].groupby('link_field', dropna=True)['link_field'].count()
     print('Determining relationship')
-    addresses['parcel_rel'] = addresses['link_field'].swifter.apply(lambda x: RelationshipSetter(x, grouped_ap, grouped_bf))
+    addresses['parcel_rel'] = addresses['link_field'].apply(lambda x: RelationshipSetter(x, grouped_ap, grouped_bf))
 
     print('Creating and exporting metrics doc as spreadsheet')
 
@@ -230,7 +230,7 @@ addresses = addresses[~addresses.index.isin(addresses_na.index.tolist())]
 
 unlinked_aps = addresses[addresses["footprint_index"].map(itemgetter(0)).isna()] # Extract unlinked addresses
 if len(addresses_na) > 0:    
-    unlinked_aps = unlinked_aps.append(addresses_na) # append unlinked addresses to the addresses_na
+    unlinked_aps = pd.concat([unlinked_aps, addresses_na]) # append unlinked addresses to the addresses_na
 
 # Separate out for the buffer phase
 # Discard non-linked addresses.
@@ -302,7 +302,7 @@ if len(unlinked_aps) > 0:
     unmatched_points = unlinked_aps[~((unlinked_aps.index.isin(list(set(no_parcel.index.to_list())))) | (unlinked_aps.index.isin(list(set(parcel_link.index.to_list())))))]
     print(f'Number of unlinked addresses {len(unmatched_points)}')
     
-    unlinked_aps = no_parcel.append(parcel_link)
+    unlinked_aps = pd.concat([no_parcel, parcel_link])
     # Take only the closest linkage for unlinked geometries
     unlinked_plural = unlinked_aps['footprint_index'].map(len) > 1
     unlinked_aps.loc[unlinked_plural, "footprint_index"] = unlinked_aps[unlinked_plural][["geometry", "footprint_index"]].apply(lambda row: get_nearest_linkage(*row), axis=1)
@@ -311,7 +311,7 @@ if len(unlinked_aps) > 0:
 
 print("Running Step 5. Merge and Export Results")
 
-outgdf = addresses.append([intersections, addresses_bp, unlinked_aps])
+outgdf = pd.concat([addresses, intersections, addresses_bp, unlinked_aps])
 
 print("Running Step 6: Change Point Location to Building Centroid")
 print('     Creating footprint centroids')
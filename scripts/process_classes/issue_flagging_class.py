@@ -7,7 +7,6 @@ from pathlib import Path
 from math import isnan
 import shapely.speedups
 import datetime
-import swifter
 import click
 shapely.speedups.enable()
 
@@ -2,9 +2,11 @@ import geopandas as gpd
 import numpy as np
 import os
 import pandas as pd
+import shapely
 import sys
-from shapely.geometry import Point
 from pathlib import Path
+from typing import Union
+from pyproj import CRS
 from dotenv import load_dotenv
 from operator import itemgetter
 sys.path.insert(1, os.path.join(sys.path[0], ".."))
@@ -23,100 +25,104 @@ Unlinked addresses and buildings will then be output for further analysis.
 '''
 
 class Matcher:
-    '''Creates a matched output from the provided inputs'''
-    def __init__(self, address_data_path:str, footprint_data_path:str, address_lyr_nme:str=None, footprint_lyr_nme:str=None, proj_crs:int=4326, footprint_join_field:str='link_field', address_join_field:str='link_field', shed_flag_field:str='shed_flag', bp_threshold:int=20, bp_area_threshold:int=20, buffer_size:int=20 ) -> None:
+    '''Creates a matched output from the provided inputs. Inputs can be paths to the layers or GeoDataFrames already in memory'''
+    def __init__(self, address_data:Union[str, Path, gpd.GeoDataFrame], footprint_data:Union[str, Path, gpd.GeoDataFrame], address_lyr_nme:str=None, footprint_lyr_nme:str=None, proj_crs:int=4326, footprint_join_field:str='link_field', address_join_field:str='link_field', shed_flag_field:str='shed_flag', bp_threshold:int=20, bp_area_threshold:int=20, buffer_size:int=20 ) -> None:
         
-        def groupby_to_list(df:pd.DataFrame, group_field:str, list_field:str) -> pd.Series:
-    
-            """
-            Helper function: faster alternative to pandas groupby.apply/agg(list).
-            Groups records by one or more fields and compiles an output field into a list for each group.
-            """
-            
-            if isinstance(group_field, list):
-                for field in group_field:
-                    if df[field].dtype.name != "geometry":
-                        df[field] = df[field].astype("U")
-                transpose = df.sort_values(group_field)[[*group_field, list_field]].values.T
-                keys, vals = np.column_stack(transpose[:-1]), transpose[-1]
-                keys_unique, keys_indexes = np.unique(keys.astype("U") if isinstance(keys, np.object) else keys, 
-                                                    axis=0, return_index=True)
-            
-            else:
-                keys, vals = df.sort_values(group_field)[[group_field, list_field]].values.T
-                keys_unique, keys_indexes = np.unique(keys, return_index=True)
-            
-            vals_arrays = np.split(vals, keys_indexes[1:])
-            
-            return pd.Series([list(vals_array) for vals_array in vals_arrays], index=keys_unique).copy(deep=True)
-
-
-        def building_area_theshold_id(building_gdf:gpd.GeoDataFrame, bf_area_threshold , area_field_name='bf_area') -> bool:
+        def building_area_theshold_id(addresses_gdf:gpd.GeoDataFrame, building_gdf:gpd.GeoDataFrame, bf_area_threshold , area_field_name='bf_area') -> pd.Series:
             '''
-            Returns a boolean on whether a majority of the buildings in the bp fall under the bp threshold defined in the environments. 
-            Buildings should be filtered to only those in the polygon before being passed into this function
+            Returns a boolean for each address point on whether a majority of the buildings linked to it fall under the bp threshold defined in the environments. 
+            Buildings are looked up by the footprint indexes linked to each address point
             '''
-            
-            all_bf_cnt = len(building_gdf)
-
-            bf_u_thresh = building_gdf[building_gdf[area_field_name] <= bf_area_threshold]
-            bf_u_thresh_cnt = len(bf_u_thresh)
+            # Pair each address point with the unique buildings it is linked to
+            linkages = addresses_gdf['footprint_index'].explode()
+            linkages = pd.DataFrame({'address_index': linkages.index, 'footprint_index': pd.to_numeric(linkages.values, errors='coerce')}).dropna().drop_duplicates()
+            linkages['u_thresh'] = linkages['footprint_index'].astype(int).map(building_gdf[area_field_name] <= bf_area_threshold)
+            linkages.dropna(subset=['u_thresh'], inplace=True)
 
-            if bf_u_thresh_cnt >= (all_bf_cnt/2):
-                return True
-            else:
-                return False
+            # Count all the linked buildings and those under the threshold for every address point in one pass
+            bf_cnts = linkages.groupby('address_index')['u_thresh'].agg(['size', 'sum'])
+            u_areaflag = bf_cnts['sum'] >= (bf_cnts['size'] / 2)
+            return u_areaflag.reindex(addresses_gdf.index, fill_value=True)
 
 
         def get_unlinked_geometry(addresses_gdf:gpd.GeoDataFrame, footprint_gdf:gpd.GeoDataFrame , buffer_distance:int=20) -> gpd.GeoDataFrame:
             'Returns indexes for the bf based on the increasing buffer size'
-            
-            def list_bf_indexes(buffer_geom, bf_gdf):
-                """
-                For parcel-less bf geometry takes the buffer from the buffer_geom field and looks for 
-                intersects based on the buffer geom. Returns a list of all indexes with true values.
-                """
-                intersects = bf_gdf.intersects(buffer_geom)
-                intersects = intersects[intersects == True]
-                intersects = tuple(intersects.index)
-                if len(intersects) > 0:
-                    return intersects
-                else: 
-                    return np.nan
-    
-            addresses_gdf['buffer_geom'] = addresses_gdf.geometry.buffer(buffer_distance)
-            addresses_gdf[f'footprint_index'] = addresses_gdf['buffer_geom'].apply(lambda point_buffer: list_bf_indexes(point_buffer, footprint_gdf))
 
-            linked_df = addresses_gdf.dropna(axis=0, subset=[f'footprint_index'])
+            # Find every footprint within the buffer distance of each address point in one query. The tree only has to compare
+            # the point against the footprint bounding boxes grown by the buffer distance so no buffer polygons are built
+            address_pos, footprint_pos = footprint_tree.query(addresses_gdf.geometry.values, predicate='dwithin', distance=buffer_distance)
+            # The shared tree holds every footprint so keep only those available to this stage
+            available = np.isin(self.footprint.index.values[footprint_pos], footprint_gdf.index)
+            address_pos = address_pos[available]
+            footprint_pos = footprint_pos[available]
+            linked_order = np.lexsort((footprint_pos, address_pos))
+            address_pos = address_pos[linked_order]
+            footprint_pos = footprint_pos[linked_order]
+
+            # Group the intersecting footprint indexes by address point, address points with no intersects are dropped
+            linked_pos, first_pos = np.unique(address_pos, return_index=True)
+            footprint_groups = np.split(self.footprint.index.values[footprint_pos], first_pos[1:]) if len(linked_pos) > 0 else []
+
+            linked_df = addresses_gdf.iloc[linked_pos]
+            linked_df['footprint_index'] = [tuple(group) for group in footprint_groups]
             linked_df['method'] = f'{buffer_distance}m buffer'
-            linked_df.drop(columns=["buffer_geom"], inplace=True)
-            addresses_gdf = addresses_gdf[~addresses_gdf.index.isin(list(set(linked_df.index.tolist())))]
             return linked_df
 
 
-        def get_nearest_linkage(ap:Point, footprint_indexes:list) -> list:
-            """Returns the footprint index associated with the nearest footprint geometry to the given address point."""  
-            # Get footprint geometries.
-            footprint_geometries = tuple(map(lambda index: self.footprint["geometry"].loc[self.footprint.index == index], footprint_indexes))
-            # Get footprint distances from address point.
-            footprint_distances = tuple(map(lambda footprint: footprint.distance(ap), footprint_geometries))                                     
-            distance_values = [a[a.index == a.index[0]].values[0] for a in footprint_distances if len(a.index) != 0]
-            distance_indexes = [a.index[0] for a in footprint_distances if len(a.index) != 0]
+        def get_nearest_linkage(addresses_gdf:gpd.GeoDataFrame) -> pd.Series:
+            """Returns the footprint index associated with the nearest linked footprint geometry for each address point."""
+            # Pair every address point with each of its linked footprints
+            linkages = [fi for fis in addresses_gdf['footprint_index'] for fi in fis]
+            address_pos = np.repeat(np.arange(len(addresses_gdf.index)), addresses_gdf['footprint_index'].map(len).to_numpy(dtype=int))
+            footprint_pos = self.footprint.index.get_indexer(linkages)
+            address_pos = address_pos[footprint_pos != -1]
+            footprint_pos = footprint_pos[footprint_pos != -1]
+
+            # Get footprint distances from the address points in one call and keep the closest footprint for each address point
+            footprint_distances = shapely.distance(addresses_gdf.geometry.values[address_pos], self.footprint.geometry.values[footprint_pos])
+            closest = np.lexsort((footprint_distances, address_pos))
+            address_pos, first_pos = np.unique(address_pos[closest], return_index=True)
+
+            # Address points with no footprint left to link to get the drop val
+            nearest = pd.Series(np.nan, index=addresses_gdf.index, dtype=object)
+            nearest.iloc[address_pos] = self.footprint.index.values[footprint_pos[closest][first_pos]]
+            return nearest
+
 
-            if len(distance_indexes) == 0: # If empty then return drop val
-                return np.nan
+        def check_for_intersects(addresses_gdf:gpd.GeoDataFrame) -> pd.Series:
+            '''Similar to the get nearest linkage function except this looks for intersects (uses prepared contains because its much faster) and spits out the index of the first linked footprint each address point falls within'''
+            # Find the candidate footprints for each address point in one query then test them against the prepared footprints
+            address_pos, footprint_pos = footprint_tree.query(addresses_gdf.geometry.values)
+            inside = shapely.contains(footprint_geoms[footprint_pos], addresses_gdf.geometry.values[address_pos])
+            address_pos = address_pos[inside]
+            footprint_pos = footprint_pos[inside]
+            within = pd.DataFrame({'address_pos': address_pos, 'footprint_index': self.footprint.index.values[footprint_pos].astype(float)})
 
-            footprint_index =  distance_indexes[distance_values.index(min(distance_values))]
-            return footprint_index
+            # Keep only the footprints linked to the address point taking them in the order they were linked
+            linkages = addresses_gdf['footprint_index'].reset_index(drop=True).explode()
+            linkages = pd.DataFrame({'address_pos': linkages.index, 'footprint_index': pd.to_numeric(linkages.values, errors='coerce')})
+            inter = linkages.merge(within, how='inner', on=['address_pos', 'footprint_index']).drop_duplicates(subset=['address_pos'], keep='first')
 
+            intersect_index = pd.Series(np.nan, index=addresses_gdf.index)
+            intersect_index.iloc[inter['address_pos'].to_numpy()] = inter['footprint_index'].to_numpy()
+            return intersect_index
 
-        def check_for_intersects(address_pt:Point, footprint_indexes: list) -> int:
-            '''Similar to the get nearest linkage function except this looks for intersects (uses within because its much faster) and spits out the index of any intersect'''
-            footprint_geometries = tuple(map(lambda index: self.footprint["geometry"].loc[self.footprint.index == index], footprint_indexes))
-            inter = tuple(map(lambda bf: address_pt.within(bf.iloc[0]), footprint_geometries))
-            if True in inter:
-                t_index = inter.index(True)
-                return int(footprint_geometries[t_index].index[0])
+
+        def load_layer(in_data, lyr_nme:str=None) -> gpd.GeoDataFrame:
+            '''Reads the layer from the given path. GeoDataFrames already in memory are copied instead of read so the inputs are left untouched'''
+            if type(in_data) == gpd.GeoDataFrame:
+                # Index labels are used as the address and footprint ids so give them a fresh unique index as read_file would
+                return in_data.reset_index(drop=True)
+            return gpd.read_file(in_data, layer=lyr_nme)
+
+
+        def reproject(ingdf:gpd.GeoDataFrame, output_crs:CRS) -> gpd.GeoDataFrame:
+            ''' Takes a gdf and tests to see if it is in the output crs if it is not the funtions will reproject '''
+            if ingdf.crs == None:
+                ingdf.set_crs(output_crs, inplace=True)
+            elif not ingdf.crs.equals(output_crs):
+                ingdf.to_crs(output_crs, inplace=True)
+            return ingdf
 
 
         def as_int(val):
@@ -130,18 +136,10 @@ class Matcher:
                 return val
 
 
-        def create_centroid_match(footprint_index:int, bf_centroids):
-            '''Returns the centroid geometry for a given point'''
-            new_geom = bf_centroids.iloc[int(footprint_index)]
-            return new_geom
-
-
         # Step 1: Import key layers and reproject them
-        self.addresses = gpd.read_file(address_data_path, layer=address_lyr_nme, crs=proj_crs)
-        self.footprint = gpd.read_file(footprint_data_path, layer=footprint_lyr_nme, crs=proj_crs)
-
-        self.addresses.to_crs(crs=proj_crs, inplace=True)
-        self.footprint.to_crs(crs=proj_crs, inplace=True)
+        proj_crs = CRS.from_epsg(proj_crs)
+        self.addresses = reproject(load_layer(address_data, address_lyr_nme), proj_crs)
+        self.footprint = reproject(load_layer(footprint_data, footprint_lyr_nme), proj_crs)
 
         # Step 2: Configure address to footprint linkages
         self.addresses["addresses_index"] = self.addresses.index
@@ -151,30 +149,41 @@ class Matcher:
         self.sheds = self.footprint[self.footprint[shed_flag_field] == True] # Set aside for use in future if sheds need to be matched
         self.footprint = self.footprint[self.footprint[shed_flag_field] == False]
 
+        # Prepare the footprints and build their tree once so the intersect and buffer stages below reuse them
+        footprint_geoms = np.asarray(self.footprint.geometry.values)
+        shapely.prepare(footprint_geoms)
+        footprint_tree = shapely.STRtree(footprint_geoms)
+
         print('     creating and grouping linkages')
         merge = self.addresses[~self.addresses[address_join_field].isna()].merge(self.footprint[[footprint_join_field, "footprint_index"]], how="left", left_on=address_join_field, right_on=footprint_join_field)
-        self.addresses['footprint_index'] = groupby_to_list(merge, "addresses_index", "footprint_index")
+        self.addresses['footprint_index'] = merge.groupby("addresses_index", sort=False)["footprint_index"].agg(list)
         self.addresses.drop(columns=["addresses_index"], inplace=True)
 
         # Big Parcel (BP) case extraction (remove and match before all other cases
-        bf_counts = self.footprint.groupby(footprint_join_field, dropna=True)[footprint_join_field].count()
-        ap_counts = self.addresses.groupby(address_join_field, dropna=True)[address_join_field].count()
+        # Encode the parcel links of both inputs with one shared set of codes so both counts are simple bincounts (missing links are coded -1)
+        link_codes, link_uniques = pd.factorize(pd.concat([self.footprint[footprint_join_field], self.addresses[address_join_field]], ignore_index=True))
+        bf_codes = link_codes[:len(self.footprint.index)]
+        ap_codes = link_codes[len(self.footprint.index):]
+        bf_counts = np.bincount(bf_codes[bf_codes >= 0], minlength=len(link_uniques))
+        ap_counts = np.bincount(ap_codes[ap_codes >= 0], minlength=len(link_uniques))
 
         # Take only parcels that have more than the big parcel (bp) threshold intersects of both a the inputs
-        addresses_bp = self.addresses.loc[(self.addresses[address_join_field].isin(bf_counts[bf_counts > bp_threshold].index.tolist())) & (self.addresses[address_join_field].isin(ap_counts[ap_counts > bp_threshold].index.tolist()))]
+        # The trailing False is picked up by the -1 code so addresses with no parcel link are never big parcel addresses
+        big_parcels = np.append((bf_counts > bp_threshold) & (ap_counts > bp_threshold), False)
+        addresses_bp = self.addresses.loc[big_parcels[ap_codes]]
         
         if len(addresses_bp) > 0:
             # return all addresses with a majority of the buildings under the area threshold
-            addresses_bp['u_areaflag'] = addresses_bp['footprint_index'].apply(lambda x: building_area_theshold_id(self.footprint[self.footprint['footprint_index'].isin(x)], bp_area_threshold)) 
+            addresses_bp['u_areaflag'] = building_area_theshold_id(addresses_bp, self.footprint, bp_area_threshold)
             addresses_bp = addresses_bp.loc[addresses_bp['u_areaflag'] == True]
             addresses_bp.drop(columns=['u_areaflag'], inplace=True)
 
-            self.addresses =  self.addresses[~self.addresses.index.isin(addresses_bp.index.tolist())]
+            self.addresses =  self.addresses[~self.addresses.index.isin(addresses_bp.index)]
             addresses_bp = get_unlinked_geometry(addresses_bp, self.footprint, buffer_distance=buffer_size)
 
             # Find and reduce plural linkages to the closest linkage
             ap_bp_plural = addresses_bp['footprint_index'].map(len) > 1
-            addresses_bp.loc[ap_bp_plural, "footprint_index"] = addresses_bp[ap_bp_plural][["geometry", "footprint_index"]].apply(lambda row: get_nearest_linkage(*row), axis=1)
+            addresses_bp.loc[ap_bp_plural, "footprint_index"] = get_nearest_linkage(addresses_bp[ap_bp_plural])
             addresses_bp.loc[~ap_bp_plural, "footprint_index"] = addresses_bp[~ap_bp_plural]["footprint_index"].map(itemgetter(0))
             addresses_bp['method'] = addresses_bp['method'].astype(str) + '_bp'
             addresses_bp['method'] = addresses_bp['method'].str.replace(' ','_')
@@ -182,11 +191,11 @@ class Matcher:
         # Extract non-linked addresses if any.
         print('     extracting unlinked addresses')
         addresses_na = self.addresses[self.addresses['footprint_index'].isna()] # Special cases with NaN instead of a tuple
-        self.addresses = self.addresses[~self.addresses.index.isin(addresses_na.index.tolist())]
+        self.addresses = self.addresses[~self.addresses.index.isin(addresses_na.index)]
 
         unlinked_aps = self.addresses[self.addresses["footprint_index"].map(itemgetter(0)).isna()] # Extract unlinked addresses
         if len(addresses_na) > 0:    
-            unlinked_aps = unlinked_aps.append(addresses_na) # append unlinked addresses to the addresses_na
+            unlinked_aps = pd.concat([unlinked_aps, addresses_na]) # append unlinked addresses to the addresses_na
 
         # Separate out for the buffer phase
         # Discard non-linked addresses.
@@ -194,21 +203,17 @@ class Matcher:
 
         print('Running Step 3. Checking address linkages via intersects')
 
-        self.addresses['intersect_index'] = self.addresses[["geometry", "footprint_index"]].apply(lambda row: check_for_intersects(*row), axis=1)
+        self.addresses['intersect_index'] = check_for_intersects(self.addresses)
         # Clean footprints remove none values and make sure that the indexes are integers
         intersections = self.addresses.dropna(axis=0, subset=['intersect_index'])
 
         self.addresses = self.addresses[self.addresses.intersect_index.isna()] # Keep only address points that were not intersects
         self.addresses.drop(columns=['intersect_index'], inplace=True) # Now drop the now useless intersects_index column
 
-        intersect_a_points = list(set(intersections.intersect_index.tolist()))
-
         self.addresses.dropna(axis=0, subset=['footprint_index'], inplace=True)
 
         intersections['intersect_index'] = intersections['intersect_index'].astype(int)
 
-        intersect_indexes = list(set(intersections.index.tolist()))
-
         intersections['footprint_index'] = intersections['intersect_index']
         intersections.drop(columns='intersect_index', inplace=True)
         intersections['method'] = 'intersect'
@@ -216,11 +221,6 @@ class Matcher:
         # footprint = footprint[~footprint.index.isin(list(set(intersections.footprint_index.tolist())))] # remove all footprints that were matched in the intersection stage
         print('Running Step 4. Creating address linkages using linking data')
 
-        # Ensure projected crs is used
-        intersections.to_crs(crs=proj_crs, inplace=True)
-        self.addresses.to_crs(crs= proj_crs, inplace=True)
-        self.footprint.to_crs(crs=proj_crs, inplace=True)
-
         # Convert linkages to integer tuples, if possible.
         self.addresses["footprint_index"] = self.addresses["footprint_index"].map(lambda vals: tuple(set(map(as_int, vals))))
 
@@ -235,7 +235,6 @@ class Matcher:
         print('     get linkages via buffer')
         if len(unlinked_aps) > 0:
             
-            unlinked_aps.to_crs(proj_crs, inplace=True)
             unlinked_aps.drop(columns=['footprint_index'], inplace=True)
 
             # split into two groups = points linked to a parcel - run against full building dataset, points with no footprint - only run against unlinked buildings
@@ -243,8 +242,8 @@ class Matcher:
             parcel_link = unlinked_aps[~unlinked_aps['link_field'].isna()]
 
             # get all footprint_indexes (fi) from the previous steps to exclude in the next step for no parcel aps
-            intersect_fi = list(set(intersections.footprint_index.tolist()))
-            linking_fi = list(set(self.addresses.footprint_index.tolist()))
+            intersect_fi = intersections['footprint_index'].unique()
+            linking_fi = self.addresses['footprint_index'].unique()
 
             # Bring in only those footprints that haven't yet been matched to remove matches on buildings already matched
             unlinked_footprint = self.footprint[~(self.footprint['footprint_index'].isin(linking_fi) | self.footprint['footprint_index'].isin(intersect_fi))]
@@ -255,36 +254,30 @@ class Matcher:
             parcel_link = get_unlinked_geometry(parcel_link, self.footprint, buffer_size)
             
             # Grab those records that still have no link and export them for other analysis
-            unmatched_points = unlinked_aps[~((unlinked_aps.index.isin(list(set(no_parcel.index.to_list())))) | (unlinked_aps.index.isin(list(set(parcel_link.index.to_list())))))]
+            unmatched_points = unlinked_aps[~unlinked_aps.index.isin(no_parcel.index.append(parcel_link.index))]
             print(f'Number of unlinked addresses {len(unmatched_points)}')
             
-            unlinked_aps = no_parcel.append(parcel_link)
+            unlinked_aps = pd.concat([no_parcel, parcel_link])
             # Take only the closest linkage for unlinked geometries
             unlinked_plural = unlinked_aps['footprint_index'].map(len) > 1
-            unlinked_aps.loc[unlinked_plural, "footprint_index"] = unlinked_aps[unlinked_plural][["geometry", "footprint_index"]].apply(lambda row: get_nearest_linkage(*row), axis=1)
+            unlinked_aps.loc[unlinked_plural, "footprint_index"] = get_nearest_linkage(unlinked_aps[unlinked_plural])
             unlinked_aps = unlinked_aps.explode('footprint_index')
             unlinked_aps['method'] = f'{buffer_size}m_buffer'
 
         print("Running Step 5. Merge and Export Results")
 
-        self.outgdf = self.addresses.append([intersections, addresses_bp, unlinked_aps])
+        self.outgdf = pd.concat([self.addresses, intersections, addresses_bp, unlinked_aps])
 
         print("Running Step 6: Change Point Location to Building Centroid")
         print('     Creating footprint centroids')
-        self.footprint['centroid_geo'] = self.footprint['geometry'].apply(lambda bf: bf.representative_point())
+        footprint_centroids = shapely.point_on_surface(self.footprint.geometry.values)
         print('     Matching address points with footprint centroids')
-        self.outgdf['out_geom'] = self.outgdf['footprint_index'].apply(lambda row: create_centroid_match(row, self.footprint['centroid_geo']))
-
-        self.outgdf = self.outgdf.set_geometry('out_geom')
-
-        self.outgdf.drop(columns='geometry', inplace=True)
-        self.outgdf.rename(columns={'out_geom':'geometry'}, inplace=True)
-        self.outgdf = self.outgdf.set_geometry('geometry')
-
-        self.footprint.drop(columns='centroid_geo', inplace=True)
+        # Look up each matched footprint by its index label as sheds have already been removed from the footprints
+        footprint_pos = self.footprint.index.get_indexer(self.outgdf['footprint_index'].astype(int))
+        self.outgdf['geometry'] = gpd.GeoSeries(footprint_centroids[footprint_pos], index=self.outgdf.index, crs=self.footprint.crs)
 
         # Find unlinked building polygons
-        self.unlinked_footprint = self.footprint[~self.footprint['footprint_index'].isin(self.outgdf['footprint_index'].to_list())]
+        self.unlinked_footprint = self.footprint[~self.footprint['footprint_index'].isin(self.outgdf['footprint_index'].unique())]
 
 
     def export_matches(self, output_gpkg:str, matches_lyr_nme:str='matched_points', sheds_lyr_nme:str='non_add_ob') -> None: